@@ -1,5 +1,6 @@
 # Use canvasapi to obtain information from college classes
 import os #to create directories to save course material
+from pathlib import Path #to build the paths that course material is saved under
 from canvasapi import Canvas
 from canvasapi.exceptions import ResourceDoesNotExist #to raise and intercept errors from file not existing
 from canvasapi.exceptions import Forbidden #to catch when we cannot access files of the course directly
@@ -77,7 +78,7 @@ def download_file(file, dir, urls):
         os.makedirs(dir)
     
     # Create a path to save the file in.
-    file_path = f"{dir}/{make_valid_folder_name(file.display_name, is_file = True)}"
+    file_path = dir / make_valid_folder_name(file.display_name, is_file = True)
 
     # Check to see if the file already exists; if not, we can attempt to downlaod the file.
     # If the file doesn't download, we can print the file's name, associated error, and continue.
@@ -176,32 +177,29 @@ def valid_filetype(file):
 
 ### Load all relevant information into python file
 ## Locate current operation directory
-current_dir = os.path.dirname(os.path.abspath(__file__))
+current_dir = Path(__file__).resolve().parent
 
 ## Load list of course_ids that we are skipping from the .txt file
-skip_courses_ls = open(f'{current_dir}/skip_courses.txt', 'r')
+# Store course IDs in this set for the classes whose materials you do NOT want to download. The whole file
+# is read at once and split on whitespace in a single call, which also skips blank lines (such as the ' \n'
+# written below on every run); int accepts the resulting bytes directly.
+with open(current_dir / 'skip_courses.txt', 'rb') as skip_courses_ls:
+    skip_course_ids = set(map(int, skip_courses_ls.read().split()))
 
-# Store course IDs in this set for the classes whose materials you do NOT want to download.
-skip_course_ids = set()
-for course_id_str in skip_courses_ls.readlines():
-    skip_course_ids.add(int(course_id_str))
-
-# Once we have finished this, close the text file and reopen it in append mode to add courses that
-# have been downloaded. 
-skip_courses_ls.close()
-skip_courses_ls = open(f'{current_dir}/skip_courses.txt', 'a')
+# Once we have finished this, reopen the text file in append mode to add courses that have been downloaded. 
+skip_courses_ls = open(current_dir / 'skip_courses.txt', 'a')
 
 # Append a '\n' to start on a new line (regardless of what course number you've placed down)
 skip_courses_ls.write(' \n')
 
 ## Load credentials from the .yaml file
-with open(f'{current_dir}/creds.yaml', 'r') as f:
+with open(current_dir / 'creds.yaml', 'r') as f:
     creds = yaml.safe_load(f)
 
 # Unpack relevant information
 API_URL = creds['API_URL']
 KEY = creds['KEY']
-save_path = creds['SAVE_PATH']
+save_path = Path(creds['SAVE_PATH'])
 
 # Initialize new Canvas object and extract user
 canvas = Canvas(API_URL, KEY)
@@ -230,7 +228,7 @@ for current_course in canvas.get_courses():
     course_items_urls = set()
 
     # For this course, create a folder with the name given in the system for the course. 
-    course_folder_path = f'{save_path}/{make_valid_folder_name(current_course.name)}'
+    course_folder_path = save_path / make_valid_folder_name(current_course.name)
     if not os.path.exists(course_folder_path):
         os.makedirs(course_folder_path)
 
@@ -238,13 +236,13 @@ for current_course in canvas.get_courses():
     modules_i = current_course.get_modules()
 
     # Create a directory for all module items
-    modules_dir = f'{course_folder_path}/Modules'
+    modules_dir = course_folder_path / 'Modules'
 
     # Iterate over each module
     for module_i in modules_i:
 
         # For each module, create yet another sub_directory.
-        module_dir = f'{modules_dir}/{make_valid_folder_name(module_i.name)}'
+        module_dir = modules_dir / make_valid_folder_name(module_i.name)
 
         # For each module, retrieve its items
         module_items = module_i.get_module_items()
@@ -271,7 +269,7 @@ for current_course in canvas.get_courses():
 
     ## Get Assignment Items
     # Create a folder for assignments
-    assignments_dir = f'{course_folder_path}/Assignments'
+    assignments_dir = course_folder_path / 'Assignments'
 
     # Obtain all assignments
     all_assignments = current_course.get_assignments()
@@ -291,7 +289,7 @@ for current_course in canvas.get_courses():
         assignment = current_course.get_assignment(assignment_id)
 
         # Obtain name of this assignment and create a new folder to save the assignment's materials into
-        assignment_dir = f'{assignments_dir}/{make_valid_folder_name(assignment.name)}'
+        assignment_dir = assignments_dir / make_valid_folder_name(assignment.name)
 
         # Get Page object associated with assignment
         assignment_page = assignment.description
@@ -301,34 +299,43 @@ for current_course in canvas.get_courses():
             download_files_from_html(assignment_page, current_course, assignment_dir, course_items_urls)
 
     ## Get files stored under the Files section, which we can get via get_folders. 
-    Files_dir = f'{course_folder_path}'
-    folders = current_course.get_folders()
+    # If the Files section is hidden from students, even listing the folders is forbidden.
+    Files_dir = course_folder_path
+    try:
+        folders = list(current_course.get_folders())
+    except Forbidden:
+        print(f'The Files section of {current_course.name} could not be accessed.')
+        folders = []
+
     for folder in folders:
 
         # Create folder path combined with the Files_dir
-        folder_path = f'{Files_dir}/{folder}'
+        folder_path = Files_dir / str(folder)
         
         # Get all the files from each folder, and download the file only if it has not already been
         # downloaded previously.
         folder_files = folder.get_files()
 
-        # Attempt to access the files. If it is forbidden, break out of for loop (we do not have
-        # the necessary permissions to download).
+        # Attempt to access the files. If it is forbidden, we do not have the necessary permissions to
+        # download from this folder, but may still have them for the next one.
         try:
             for file in folder_files:
                 download_file(file, folder_path, course_items_urls)
         except Forbidden:
-            break
+            print(f'The folder {folder} could not be accessed.')
+            continue
 
     # Once we have downloaded everything from this course, we want to update the text file with 
     # the course id and make sure that it gets saved on the txt file in case of a crash.
     skip_courses_ls.write(str(current_id) + ' \n')
 
-    # Ensure the changes are saved in case of program crash
+    # Hand the changes to the operating system so that they survive the program crashing. We do not fsync
+    # here: that waits for the disk on every course, and the downloaded files themselves are not fsync'd
+    # either, so it would not protect against a power loss anyway.
     skip_courses_ls.flush()
-    os.fsync(skip_courses_ls.fileno())
 
-# After all the courses have been downloaded, we can just close the text file we've been using.
+# After all the courses have been downloaded, make sure the text file we've been using is on disk and close it.
+os.fsync(skip_courses_ls.fileno())
 skip_courses_ls.close()
 
 
@@ -1,9 +1,24 @@
 # Use canvasapi to obtain information from college classes
 import os #to create directories to save course material
+import shutil #to copy files where they cannot be linked
+from pathlib import Path #to build the paths that course material is saved under
+import re #to pick file ids out of links
+import html #to decode entities (e.g. &amp;) in links found without an HTML parser
+import functools #to remember names we have already made valid
+import hashlib #to recognize files with identical contents
+import json #to save the contents of downloaded files between runs
+import queue #to hand out reusable download buffers between threads
+import time #to wait before retrying a failed download
+import urllib.parse #to resolve links and read file names sent by the server
+import requests #to stream file downloads straight to disk
+from requests.adapters import HTTPAdapter #to keep a pool of open connections to Canvas
+from urllib3.util.retry import Retry #to retry requests that Canvas rejects because it is busy
+import urllib3.exceptions #to catch connection errors while reading a download
+from concurrent.futures import ThreadPoolExecutor #to page through Canvas lists in the background
 from canvasapi import Canvas
 from canvasapi.exceptions import ResourceDoesNotExist #to raise and intercept errors from file not existing
 from canvasapi.exceptions import Forbidden #to catch when we cannot access files of the course directly
-from bs4 import BeautifulSoup #to parse HTML into a python-readable format
+from selectolax.lexbor import LexborHTMLParser #to parse HTML into a python-readable format
 
 # Import framework to support executable file, namely tkinter
 import threading
@@ -11,10 +26,267 @@ import tkinter as tk
 from tkinter import filedialog
 from tkinter import messagebox
 
+# Downloads are network-bound, so we run them on several worker threads. The download thread walks
+# through the courses and puts (file, directory, store directory, urls) items on a queue that the workers take from.
+# The queue is bounded so that listing courses never runs too far ahead of the downloads.
+download_workers = 16
+work_queue_size = 64
+
+# A few more threads make requests to Canvas in the background: they page through a course's assignments
+# and folders while its modules are being processed, and fetch the pages of each module.
+pagination_workers = 4
+pagination_executor = ThreadPoolExecutor(max_workers = pagination_workers)
+
+# Files are streamed to disk in 1 MiB chunks. Each worker borrows one of these preallocated buffers for
+# the length of a download, so memory use does not grow with the size of the file.
+chunk_size = 1024 * 1024
+buffer_pool = queue.Queue()
+for _ in range(download_workers):
+    buffer_pool.put(bytearray(chunk_size))
+
+# Downloads that fail because of the connection (dropped, timed out) are retried a few times, waiting
+# 1, 2, then 4 seconds in between. download_file returns retry_download to ask for another attempt.
+request_timeout = 60
+max_retries = 3
+retry_download = object()
+
+# All downloads go through one session, so connections to Canvas are kept alive and reused instead of
+# paying for a new TLS handshake on every file. See mount_connection_pool.
+session = requests.Session()
+
+# Canvas renders links as <a href="..."> and <embed href="..."> with quoted attributes, so the links to
+# course files can be found by scanning the raw HTML without building a document at all.
+file_link_regex = re.compile(r'<(?:a|embed)\b[^>]*?\bhref\s*=\s*["\']([^"\']*?/files/[^"\']+)["\']', re.IGNORECASE)
+
+# Names of the files found in each directory we have downloaded into, so that checking whether a file
+# already exists is a set lookup instead of a trip to the file system.
+dir_cache = {}
+dir_cache_lock = threading.Lock()
+
+# Directories we have already created (or found to exist) during this run, so that each one costs at
+# most a single os.makedirs call.
+ensured_dirs = set()
+ensured_dirs_lock = threading.Lock()
+
+# Every file of a course is downloaded once, into this folder of the course, named by its file id alone: a
+# file found through a link gets its name from the server, which need not match its name in Canvas. The
+# modules, assignments and folders it was found in get a link to that copy (see link_pending_files).
+file_store_dirname = '_Files'
+
+# Name of the file in the save path that records every file downloaded so far (its url, and the SHA-256
+# digest and path of what we saved), one line of JSON per file.
+download_log_filename = '.cbd_downloads.jsonl'
+
+# Translation table between the characters that make a folder name invalid to what we would like to
+# replace them with. Built once here since make_valid_folder_name runs for every course, module and file.
+invalid_chars_table = str.maketrans({c: '_' for c in '\\/:*?"<>|'})
+
+# Links to course files look like .../files/<id>, optionally followed by /download or /preview and a query
+# string (usually "?verifier=", the temporary access key). Links with "?wrap=" are skipped. Only the start of
+# the query string needs to be looked at, so one search both recognizes a link and captures its id.
+file_href_regex = re.compile(r'/files/(\d+)(?:/(?:download|preview))?(?:\?(?!wrap=)|$)')
+
+# The file name in a Content-Disposition header, either as filename*=UTF-8''<percent-encoded name> or as
+# filename="<name>". The first form is preferred when both are sent.
+disposition_filename_regex = re.compile(r'filename\*\s*=\s*(?:UTF-8)?\'[^\']*\'([^;]+)|filename\s*=\s*"?([^";]+)"?', re.IGNORECASE)
+
+# File extensions we do not download (videos). Files sent as any video/* content type are skipped as well.
+unwanted_filetypes = frozenset({'mp4', 'mov', 'webm', 'wmv', 'flv', 'ogv', 'avi', 'mkv', 'm4v'})
 
 # ---------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------
 # FUNCTION DEFINITIONS ------------------------------------------------------------------------
+class FileLink:
+    """
+    Link to a course file that carries its own access key ("?verifier=..."), so that the file can be downloaded
+        straight from the link instead of being looked up in Canvas first. Takes the place of a File object
+        on the work queue; see download_url.
+    """
+    def __init__(self, url, file_id):
+        self.url = url
+        self.id = file_id
+        self.display_name = f'file {file_id}'
+
+class CourseStore:
+    """
+    Store directory of a course (see file_store_dirname), together with every place its files were found in.
+        Also counts the course's files still waiting on the work queue or being downloaded, so that the files
+        are placed (see link_pending_files) as soon as the last of them is done, while the workers carry on
+        with the files of the next course.
+    """
+    def __init__(self, dir):
+        self.dir = dir
+
+        # (copy in the store, directory it should also appear in, its name there) for every place a file was
+        # found in. A file found through a link is recorded before we know its name (None), so that it is
+        # placed wherever it was found even if it was downloaded from another page; its name is filled in
+        # from link_names once Canvas sends it.
+        # Files written to the store during this run replace their old copies, so their links are made again.
+        self.pending_links = set()
+        self.link_names = {}
+        self.updated_files = set()
+        self.lock = threading.Lock()
+        self._outstanding = 0
+        self._listed = False
+
+    def place(self, store_path, dir, name = None):
+        with self.lock:
+            self.pending_links.add((store_path, dir, name))
+
+    def name_link(self, store_path, name):
+        with self.lock:
+            self.link_names[store_path] = name
+
+    def mark_updated(self, store_path):
+        with self.lock:
+            self.updated_files.add(store_path)
+
+    def add_item(self):
+        with self.lock:
+            self._outstanding += 1
+
+    def item_done(self):
+        # Called by a worker once it is done with one of the course's files. The last one places the files
+        # if the whole course has been gone through.
+        with self.lock:
+            self._outstanding -= 1
+            ready = self._listed and self._outstanding == 0
+        if ready:
+            link_pending_files(self)
+
+    def listing_done(self):
+        # Called once every file of the course has been handed to the workers. Nothing is added after this,
+        # so the files are placed exactly once: here, or by whichever worker finishes the last file.
+        with self.lock:
+            self._listed = True
+            ready = self._outstanding == 0
+        if ready:
+            link_pending_files(self)
+
+class ShardedSet:
+    """
+    Thread-safe set, split into several smaller sets that each have their own lock. Worker threads that
+        touch different urls rarely end up waiting on the same lock.
+    """
+    def __init__(self, n = 16):
+        self._locks = [threading.Lock() for _ in range(n)]
+        self._sets = [set() for _ in range(n)]
+
+    def _shard(self, x):
+        return hash(x) % len(self._sets)
+
+    def __contains__(self, x):
+        i = self._shard(x)
+        with self._locks[i]:
+            return x in self._sets[i]
+
+    def add(self, x):
+        i = self._shard(x)
+        with self._locks[i]:
+            self._sets[i].add(x)
+
+    def add_if_absent(self, x):
+        # Adds x and returns True, or returns False if x was already in the set. Checking and adding
+        # happen under the same lock, so only one thread can ever claim a given item.
+        i = self._shard(x)
+        with self._locks[i]:
+            if x in self._sets[i]:
+                return False
+            self._sets[i].add(x)
+            return True
+
+    def discard(self, x):
+        i = self._shard(x)
+        with self._locks[i]:
+            self._sets[i].discard(x)
+
+class DownloadLog(ShardedSet):
+    """
+    ShardedSet of the urls of the files claimed for download during this run, together with the SHA-256
+        digest of each downloaded file and the path (relative to the save path) of a file that had those
+        contents. Every download is appended to a file in the save path as a line of JSON, so that the next
+        run skips files it already has right away (see logged), and recognizes files identical to ones from
+        earlier runs (e.g. lecture slides reposted in a new semester's course). Files found through links also
+        record the name Canvas sent for them, so that they can be placed without asking for them again.
+    """
+    def __init__(self, root, log_path, n = 16):
+        super().__init__(n)
+        self.root = root
+        self.log_path = log_path
+        self._logged = set()
+        self._paths = {}
+        self._names = {}
+        self._paths_lock = threading.Lock()
+        self._log_lock = threading.Lock()
+
+        # Load the records saved by previous runs, if there were any. Later lines take precedence. Records are
+        # not synced to disk one by one, so a crash can leave the last line cut short (or damaged); such lines
+        # are skipped rather than stopping the run.
+        if log_path.exists():
+            line = ''
+            with open(log_path, 'r', errors = 'replace') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        url = record['url']
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    self._logged.add(url)
+                    if record.get('name'):
+                        self._names[url] = record['name']
+                    if record.get('sha256') and record.get('path'):
+                        self._paths[record['sha256']] = record['path']
+
+            # End a line that was cut short, so that the next record starts on a line of its own.
+            if line and not line.endswith('\n'):
+                with open(log_path, 'a') as f:
+                    f.write('\n')
+
+    def logged(self, url):
+        # Returns whether a previous run already downloaded (or found that we had) the file at url. This set
+        # is only read after loading, so it needs no lock.
+        return url in self._logged
+
+    def link_name(self, url):
+        # Returns the name a previous run was sent for the file at url, or None if it does not know one.
+        return self._names.get(url)
+
+    def original_path(self, digest, path):
+        # Returns the path of an earlier file with this digest, if that file still exists. Otherwise, takes
+        # path as the file with this digest and returns None.
+        relative_path = str(path.relative_to(self.root))
+        with self._paths_lock:
+            if self._paths.get(digest) == relative_path:
+                return None
+            if digest in self._paths:
+                original = self.root / self._paths[digest]
+                if original.exists():
+                    return original
+
+            self._paths[digest] = relative_path
+        return None
+
+    def persist(self, url, digest = None, path = None, name = None):
+        # Appends a record of the url to the file, with the digest and path of the file we saved if we
+        # downloaded it, and the name Canvas sent for it if it was found through a link. The url must already
+        # be in the set (see add_if_absent). A url that was already logged by a previous run is only recorded
+        # again if it was downloaded again, or if its name is new.
+        if digest is None and url in self._logged and name in (None, self._names.get(url)):
+            return
+        record = {'url': url}
+        if digest is not None:
+            record['sha256'] = digest
+            record['path'] = str(path.relative_to(self.root))
+        if name is not None:
+            record['name'] = name
+
+        with self._log_lock:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+# Many items in a course share a name (e.g. the same folder name under several modules), so the results
+# are cached.
+@functools.lru_cache(maxsize = 4096)
 def make_valid_folder_name(input_name, is_file = False):
     """
     inputs:
@@ -23,169 +295,778 @@ def make_valid_folder_name(input_name, is_file = False):
     returns:
         - str object, valid name for a folder
     """
-    output = input_name
     # If the input name is longer than 120 characters, this may cause the system to flag it as too long
-    # of a filename. Truncate this.
-    if len(input_name) > 120:
-        output = output[:120]
+    # of a filename, so truncate it. Then use translate to map out all invalid characters and strip
+    # whitespaces as well.
+    output = input_name[:120].translate(invalid_chars_table).strip()
 
-    # Create a translation table between the characters that make a folder name invalid to
-    # what we would like to replace them with.
-    rep = {ord('\\'): '_', ord('/'): '_', ord(':'): '_', ord('*'): '_', ord('?'): '_',
-           ord('"'): '_', ord('<'): '_', ord('>'): '_', ord('|'): '_'}
+    # If we are dealing with a folder, remove any trailing periods. Windows does not allow folder names to
+    # end in a space either, and removing the periods can leave one behind (e.g. 'Week 1 ...').
+    if not is_file:
+        output = output.rstrip('. ')
 
-    # Use translate to map out all invalid strings. Strip whitespaces as well.
-    output = output.translate(rep).strip()
+    # A name made up entirely of characters we removed would point at the parent folder instead.
+    if not output:
+        output = '_'
 
-    # If we are dealing with a folder, remove any trailing periods
-    if not is_file:
-        # First check if there is a single trailing period;
-        if output[-1] == '.':
+    return output
 
-            # If there are two consecutive periods, split on the double periods and take the 
-            # first string in split.
-            if output[-2:] == '..':
-                output = output.split('..')[0]
+def list_directory(dir):
+    """
+    Returns the set of file names in the given directory. The directory is only read from disk the first
+        time it is asked for; after that the cached set is returned (and kept up to date by download_file).
+
+    Parameters:
+        - dir: Path of the directory to list
 
-            # If this is not the case, that means that there is only one period at the end 
-            # of the string. Just remove that period!
+    Returns:
+        - set of file names in the directory (empty if the directory does not exist yet)
+    """
+    with dir_cache_lock:
+        if dir not in dir_cache:
+            # A single os.scandir both reads the directory and tells us whether it exists. If it does, it
+            # will not need to be created by ensure_directory either.
+            try:
+                with os.scandir(dir) as entries:
+                    dir_cache[dir] = {entry.name for entry in entries}
+            except FileNotFoundError:
+                dir_cache[dir] = set()
             else:
-                output = output[:-1]
-        
+                with ensured_dirs_lock:
+                    ensured_dirs.add(dir)
+        return dir_cache[dir]
 
-    return output
+def mount_connection_pool(session):
+    """
+    Gives the session a connection pool large enough for all of the worker threads (the default only
+        keeps 10 connections), and has it retry requests that fail because Canvas is rate limiting us
+        or temporarily unavailable.
+
+    Parameters:
+        - session: requests.Session to configure
+
+    Returns:
+        - None, mounts the adapter on the session
+    """
+    retries = Retry(total = 3, backoff_factor = 0.5, status_forcelist = [429, 500, 502, 503, 504])
+    pool_size = download_workers + pagination_workers + 1
+    adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size, max_retries = retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+mount_connection_pool(session)
+
+def open_download(url, key, validators = None):
+    """
+    Requests the given url, returning the response as soon as its headers have arrived. The body is left
+        to be read (see save_response), so the headers can be checked before any of it is downloaded; the
+        caller is responsible for closing the response.
+
+    Parameters:
+        - url: url of the file to download
+        - key: Canvas access token
+        - validators: dict of the ETag/Last-Modified saved with our copy of the file, if we have one. The
+          file is then only sent if it has changed since.
+
+    Returns:
+        - requests.Response, or None if our copy is still up to date
+    """
+    # requests asks for gzip/deflate by default. Course files are mostly PDFs, slides and archives that are
+    # already compressed, so asking for them as they are lets their bytes go from the socket straight into
+    # our buffer instead of through zlib one small piece at a time.
+    headers = {'Authorization': f'Bearer {key}', 'Accept-Encoding': 'identity'}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    response = session.get(url, headers = headers, stream = True, timeout = request_timeout)
+    if response.status_code == 304:
+        response.close()
+        return None
+    if response.status_code == 404:
+        response.close()
+        raise ResourceDoesNotExist('Not Found')
+    try:
+        response.raise_for_status()
+    except requests.HTTPError:
+        response.close()
+        raise
+
+    # Should a server compress the file anyway, let urllib3 undo it so that readinto gives us the file's
+    # actual bytes.
+    response.raw.decode_content = True
+    return response
+
+def save_response(response, path, buf):
+    """
+    Writes the body of the given response to the given path, reading it into buf and writing it to disk one
+        chunk at a time. The file is written under a temporary name and only moved into place once it is
+        complete, so an existing copy is never replaced by a partial download.
+
+    Parameters:
+        - response: requests.Response from open_download
+        - path: Path to save the file to
+        - buf: bytearray to read the response into; its length sets the chunk size
+
+    Returns:
+        - (digest, validators): SHA-256 digest of the file's contents (computed as it is written) and the
+          response's validators to save with the file
+    """
+    view = memoryview(buf)
+    digest = hashlib.sha256()
+
+    # If anything goes wrong partway through, remove the partial file.
+    part_path = path.with_name(path.name + '.part')
+    try:
+        with open(part_path, 'wb') as f:
+            while True:
+                # Reading the raw response bypasses requests, which would otherwise turn urllib3's errors into
+                # its own. Do the same here, so that a dropped or stalled connection is retried like any other.
+                try:
+                    n = response.raw.readinto(buf)
+                except (urllib3.exceptions.ProtocolError, urllib3.exceptions.ReadTimeoutError,
+                        urllib3.exceptions.SSLError) as e:
+                    raise requests.ConnectionError(e) from e
+                except urllib3.exceptions.DecodeError as e:
+                    raise requests.exceptions.ContentDecodingError(e) from e
+                if not n:
+                    break
+                f.write(view[:n])
+                digest.update(view[:n])
+        part_path.replace(path)
+    except BaseException:
+        if part_path.exists():
+            part_path.unlink()
+        raise
+
+    new_validators = {'etag': response.headers.get('ETag'),
+                      'last_modified': response.headers.get('Last-Modified'),
+                      'content_length': response.headers.get('Content-Length')}
+
+    return digest.hexdigest(), new_validators
+
+def response_file_name(response, default):
+    """
+    Returns the name the server gave the file in its Content-Disposition header. Otherwise, the last part of
+        the url the file was served from (after any redirects) is used, or default if that is empty.
+    """
+    matches = disposition_filename_regex.findall(response.headers.get('Content-Disposition', ''))
+    for encoded_name, _ in matches:
+        if encoded_name:
+            return urllib.parse.unquote(encoded_name.strip())
+    if matches:
+        return matches[0][1].strip()
+
+    name = urllib.parse.unquote(urllib.parse.urlsplit(response.url).path.rpartition('/')[2])
+    return name or default
+
+def validators_name(file_name):
+    """
+    Returns the name of the file next to a download that holds the validators (ETag, Last-Modified,
+        Content-Length) Canvas sent with it.
+    """
+    return f'.{file_name}.etag'
+
+def read_validators(path):
+    """
+    Reads the validators saved at path, returning None if they are missing or cannot be read.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_validators(path, validators):
+    """
+    Saves the validators to path, skipping it if the server did not send any. Returns whether they were saved.
+    """
+    if validators.get('etag') or validators.get('last_modified'):
+        with open(path, 'w') as f:
+            json.dump(validators, f)
+        return True
+    return False
+
+def replace_with_link(original_path, path):
+    """
+    Replaces the file at path with a hard link to original_path, a file with the same contents, so that the
+        contents are only stored on disk once. If the file system does not support hard links, the file at
+        path is left as it is.
+
+    Parameters:
+        - original_path: Path of the file to link to
+        - path: Path of the duplicate file
 
-def download_file(file, dir, urls):
+    Returns:
+        - None
+    """
+    # Link under a temporary name first and then move the link over the duplicate, so that the file at path
+    # is never missing.
+    link_path = path.with_name(path.name + '.cbd-link')
+    try:
+        os.link(original_path, link_path)
+        link_path.replace(path)
+    except OSError:
+        if link_path.exists():
+            link_path.unlink()
+
+def ensure_directory(dir):
+    """
+    Creates the given directory (and any missing parents) unless this has already been done during
+        this run.
+
+    Parameters:
+        - dir: Path of the directory
+
+    Returns:
+        - None
+    """
+    with ensured_dirs_lock:
+        if dir in ensured_dirs:
+            return
+        dir.mkdir(parents = True, exist_ok = True)
+        ensured_dirs.add(dir)
+
+def download_file(file, dir, store, urls, key):
     """
-    Download the given file to the selected directory. Also ensures that the file has
-        not been downloaded yet.
+    Download the given file to the course's store directory, and have it linked into the selected
+        directory. Also ensures that the file has not been downloaded yet.
 
     Parameters:
         - file: File object, file to be downloaded
-        - dir: Directory to be downloaded in
-        - urls: set of file urls that have already been downloaded.
+        - dir: Path of the directory the file was found in
+        - store: CourseStore of the course, whose directory the file is downloaded into
+        - urls: DownloadLog of the files that have already been downloaded.
+        - key: Canvas access token, used to authorize the download
 
     Returns:
-        - None, downloads file into specified directory
+        - None if the file was downloaded or skipped, an error message if it could not be downloaded, or
+          retry_download if the connection failed and the download should be attempted again
     """
     print(file.display_name)
 
-    # First check to see if the file has already been downloaded; if not, we proceed to download.
+    # Wherever the file ends up coming from, it should also appear in this directory.
+    file_name = make_valid_folder_name(file.display_name, is_file = True)
+    store_name = str(file.id)
+    file_path = store.dir / store_name
+    store.place(file_path, dir, file_name)
+
+    # First check to see if the file has already been downloaded; if not, we reserve its url so that no
+    # other worker thread downloads it at the same time.
     file_url = file.url
 
-    if file_url in urls:
+    if not urls.add_if_absent(file_url):
         return
     
     # Now check to see if the file itself has been downloaded in general. 
-    # To do so, create the supposed filepath and check!
-    file_path = f"{dir}/{make_valid_folder_name(file.display_name, is_file = True)}"
-    if os.path.exists(file_path):
+    # To do so, look up the supposed filename in the store's listing and check! If we do have the file
+    # and saved its validators, ask Canvas to send it again only if it has changed since; otherwise, we
+    # keep our copy.
+    validators_path = store.dir / validators_name(store_name)
+    validators = None
+
+    listing = list_directory(store.dir)
+
+    # A file a previous run already downloaded is kept without asking Canvas, unless we saved its validators;
+    # checking those costs a request, but no download unless the file has changed. If our copy has since
+    # been deleted, it is downloaded again.
+    if urls.logged(file_url) and store_name in listing and not validators_name(store_name) in listing:
         return
 
-    # Also check to see if the file is a valid_filetype (i.e. it is not a video)
-    if not valid_filetype(file):
+    if store_name in listing:
+        if validators_name(store_name) in listing:
+            validators = read_validators(validators_path)
+
+        # An empty file without validators is a placeholder left behind by a run that was interrupted
+        # mid-download (see below); download it again. Anything else is kept.
+        elif file_path.stat().st_size > 0:
+            urls.persist(file_url)
+            return
+
+    # Also check to see if the file is a valid_filetype (i.e. it is not a video). Canvas sends a null
+    # content-type for some files, hence the "or".
+    if not valid_filetype(file.filename, getattr(file, 'content-type', None) or ''):
         return
     
-    # We must first check to see if the passed-in directory exists; if not, create it!
-    if not os.path.exists(dir):
-        os.makedirs(dir)
+    # We must first make sure that the store directory exists; if not, create it!
+    ensure_directory(store.dir)
+
+    # If this is a new file, claim its name by creating it exclusively, so that only one worker ever writes it.
+    claimed = False
+    if not store_name in listing:
+        try:
+            os.close(os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            claimed = True
+        except FileExistsError:
+            urls.persist(file_url)
+            return
+
+    # Attempt to download the file. If the file doesn't download, we can print the file's name,
+    # associated error, and continue.
+    try:
+        buf = buffer_pool.get()
+        try:
+            response = open_download(file_url, key, validators)
+            if response is None:
+                digest = None
+            else:
+                with response:
+                    # Canvas does not always know that a file is a video (e.g. when its extension was lost on
+                    # upload), but the server sending it does. Closing the response skips the rest of it.
+                    if not valid_filetype(file.filename, response.headers.get('Content-Type') or ''):
+                        if claimed:
+                            file_path.unlink()
+                        return
+                    digest, new_validators = save_response(response, file_path, buf)
+        finally:
+            buffer_pool.put(buf)
+
+    except ResourceDoesNotExist:
+        msg = f'The file {file.display_name} could not be downloaded. Resource does not exist. \n'
+
+    except MemoryError:
+        msg = f'The file {file.display_name} could not be downloaded. The file was either too large to download, or your system does not have enough space. \n'
     
-    # Create a path to save the file in.
-    file_path = f"{dir}/{make_valid_folder_name(file.display_name, is_file = True)}"
+    except (requests.ConnectionError, requests.Timeout):
+        # Release the url and the name so that the retry can claim them again.
+        urls.discard(file_url)
+        if claimed:
+            file_path.unlink()
+        return retry_download
+
+    except (OSError, requests.RequestException) as e:
+        msg = f'The file {file.display_name} could not be downloaded. {e!r} \n'
+
+    else:
+        # Our copy was still up to date.
+        if digest is None:
+            urls.persist(file_url)
+            return
+
+        # Save the validators, so that the next run can check whether the file has changed.
+        validators_saved = write_validators(validators_path, new_validators)
+
+        # If we already have a file with the same contents (e.g. the same slides uploaded to two
+        # courses), keep a single copy of them on disk.
+        original_path = urls.original_path(digest, file_path)
+        if original_path is not None:
+            replace_with_link(original_path, file_path)
+
+        with dir_cache_lock:
+            listing.add(store_name)
+            if validators_saved:
+                listing.add(validators_name(store_name))
+        store.mark_updated(file_path)
+        urls.persist(file_url, digest, file_path)
+        return
+
+    # The download failed; release the url so that the file can be retried from another location.
+    urls.discard(file_url)
+    if claimed:
+        file_path.unlink()
+    print(msg)
+    return msg
+
+def download_url(link, dir, store, urls, key):
+    """
+    Download the file behind the given link like download_file, without looking the file up in Canvas
+        first. Its name is only known once Canvas starts sending it, so that is when we check whether we
+        already have it.
+
+    Parameters:
+        - link: FileLink, link to the file to be downloaded
+        - dir: Path of the directory the file was found in
+        - store: CourseStore of the course, whose directory the file is downloaded into
+        - urls: DownloadLog of the files that have already been downloaded.
+        - key: Canvas access token, used to authorize the download
+
+    Returns:
+        - same as download_file
+    """
+    # The url carries the file's access key, so it is not printed.
+    print(link.display_name)
+
+    # Record where the file was found before anything else, so that it is placed here even if it was
+    # downloaded from another page.
+    store_name = str(link.id)
+    file_path = store.dir / store_name
+    store.place(file_path, dir)
+
+    # First check to see if the link has already been downloaded in this run; if not, reserve it.
+    if not urls.add_if_absent(link.url):
+        return
+
+    # If a previous run downloaded it and we still have it, it only needs to be placed, under the name Canvas
+    # sent then. Older records have no name, so the file is asked for again to learn it.
+    listing = list_directory(store.dir)
+    name = urls.link_name(link.url)
+    if urls.logged(link.url) and name is not None and store_name in listing:
+        store.name_link(file_path, name)
+        return
 
-    # Check to see if the file already exists; if not, we can attempt to downlaod the file.
-    # If the file doesn't download, we can print the file's name, associated error, and continue.
-    if not os.path.exists(file_path):
+    claimed = False
+    try:
+        buf = buffer_pool.get()
         try:
-            file.download(file_path)
-            urls.add(file_url)
-
-        except ResourceDoesNotExist:
-            msg = f'The file {file.display_name} could not be downloaded. Resource does not exist. \n'
-            print(msg)
-            return msg
-
-        except MemoryError:
-            msg = f'The file {file.display_name} could not be downloaded. The file was either too large to download, or your system does not have enough space. \n'
-            print(msg)
-            return msg
-        
-        except:
-            msg = f'The file {file.display_name} could not be downloaded. \n'
-            print(msg)
-            return msg
-        
-    return
+            with open_download(link.url, key) as response:
+                file_name = make_valid_folder_name(response_file_name(response, link.display_name), is_file = True)
+                store.name_link(file_path, file_name)
+
+                # Keep our copy if we already have one (see download_file for the empty placeholders).
+                if store_name in listing and file_path.stat().st_size > 0:
+                    urls.persist(link.url, name = file_name)
+                    return
+
+                # Closing the response without reading it drops the rest of the video.
+                if not valid_filetype(file_name, response.headers.get('Content-Type') or ''):
+                    return
+
+                ensure_directory(store.dir)
+                if not store_name in listing:
+                    try:
+                        os.close(os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                        claimed = True
+                    except FileExistsError:
+                        urls.persist(link.url, name = file_name)
+                        return
+
+                digest, _ = save_response(response, file_path, buf)
+        finally:
+            buffer_pool.put(buf)
+
+    except ResourceDoesNotExist:
+        msg = f'The file {link.display_name} could not be downloaded. Resource does not exist. \n'
+
+    except MemoryError:
+        msg = f'The file {link.display_name} could not be downloaded. The file was either too large to download, or your system does not have enough space. \n'
+
+    except (requests.ConnectionError, requests.Timeout):
+        urls.discard(link.url)
+        if claimed:
+            file_path.unlink()
+        return retry_download
+
+    except (OSError, requests.RequestException) as e:
+        msg = f'The file {link.display_name} could not be downloaded. {e!r} \n'
+
+    else:
+        original_path = urls.original_path(digest, file_path)
+        if original_path is not None:
+            replace_with_link(original_path, file_path)
+
+        with dir_cache_lock:
+            listing.add(store_name)
+        store.mark_updated(file_path)
+        urls.persist(link.url, digest, file_path, file_name)
+        return
+
+    urls.discard(link.url)
+    if claimed:
+        file_path.unlink()
+    print(msg)
+    return msg
 
-def download_files_from_html(loose_html, course, dir, urls):
+def download_with_retries(file, dir, store, urls, key):
     """
-    This function looks through the html and picks out file_ids for all downloadable attachments.
-    Then, we search the course object for the respective files using the file_ids to later download them.
+    Calls download_file (or download_url for a FileLink), retrying with exponential backoff while it
+        reports a connection failure. This is what the download workers run for each file.
+
+    Parameters:
+        - same as download_file
+
+    Returns:
+        - None if the file was downloaded or skipped, an error message otherwise
+    """
+    download = download_url if isinstance(file, FileLink) else download_file
+
+    file_download_msg = download(file, dir, store, urls, key)
+    for attempt in range(max_retries):
+        if file_download_msg is not retry_download:
+            return file_download_msg
+        time.sleep(2 ** attempt)
+        file_download_msg = download(file, dir, store, urls, key)
+
+    if file_download_msg is retry_download:
+        file_download_msg = f'The file {file.display_name} could not be downloaded. The connection to Canvas failed. \n'
+        print(file_download_msg)
+    return file_download_msg
+
+def link_to_store(store_path, path):
+    """
+    Makes the file at store_path appear at path as well, replacing whatever was at path. A hard link is used,
+        so that the contents are only stored on disk once; if the file system does not support them (e.g. a
+        USB drive formatted as FAT), the file is copied instead.
+
+    Parameters:
+        - store_path: Path of the file in the course's store directory
+        - path: Path the file should appear at
+
+    Returns:
+        - None
+    """
+    # Link (or copy) under a temporary name first and then move it over the old copy, so that the file at
+    # path is never missing or incomplete.
+    temp_path = path.with_name(path.name + '.cbd-link')
+    try:
+        try:
+            os.link(store_path, temp_path)
+        except OSError:
+            shutil.copyfile(store_path, temp_path)
+        temp_path.replace(path)
+    except OSError:
+        if temp_path.exists():
+            temp_path.unlink()
+        raise
+
+def link_pending_files(store):
+    """
+    Places every downloaded file in each module, assignment and folder it was found in, by linking it to
+        its copy in the course's store directory. This runs once the course's downloads have finished. Files we do
+        not have a copy of (videos, failed downloads) are skipped, as are places that already have the file
+        unless it was downloaded again during this run. If two different files would get the same name in a
+        directory, the one with the larger id is named "<name> (<id>)<extension>" instead.
+
+    Parameters:
+        - store: CourseStore of the course
+
+    Returns:
+        - None
+    """
+    with store.lock:
+        links = list(store.pending_links)
+        names = dict(store.link_names)
+        updated = set(store.updated_files)
+        store.pending_links.clear()
+        store.link_names.clear()
+        store.updated_files.clear()
+
+    # A link whose name Canvas never sent us was not downloaded, so there is nothing to place. The rest are
+    # placed in a fixed order, so that a file keeps the same name from one run to the next.
+    links = sorted((str(dir), name or names.get(store_path), int(store_path.name), store_path, dir)
+                   for store_path, dir, name in links if name or store_path in names)
+
+    claimed = {}
+    for _, name, _, store_path, dir in links:
+        if not store_path.name in list_directory(store_path.parent):
+            continue
+        path = dir / name
+        if claimed.setdefault(path, store_path) != store_path:
+            path = dir / f'{path.stem} ({store_path.name}){path.suffix}'
+        listing = list_directory(path.parent)
+        if path.name in listing and not store_path in updated:
+            continue
+
+        try:
+            ensure_directory(path.parent)
+            link_to_store(store_path, path)
+        except OSError as e:
+            print(f'The file {path.name} could not be placed in {path.parent}. {e!r}')
+            continue
+        with dir_cache_lock:
+            listing.add(path.name)
+
+def queue_download(work_q, file, dir, store, urls):
+    """
+    Hands a file over to the download workers, counting it against its course first so that the course's
+        files are not placed while it is still waiting on the queue.
+
+    Parameters:
+        - work_q: queue of files waiting to be downloaded by the workers
+        - file: File object or FileLink to be downloaded
+        - dir: Path of the directory the file was found in
+        - store: CourseStore of the course
+        - urls: DownloadLog of the files that have already been downloaded
+
+    Returns:
+        - None
+    """
+    store.add_item()
+    work_q.put((file, dir, store, urls))
+
+def index_course_files(course):
+    """
+    Lists every file in the course in one paginated request so that files can be looked up by id
+        without asking Canvas for each one separately.
+
+    Parameters:
+        - course: course object, obtained after requesting information using the canvasapi
+
+    Returns:
+        - dict mapping file ids (as strings) to File objects; empty if we cannot list the course's files
+    """
+    course_files = {}
+
+    # Listing the files of a course is forbidden when the Files section is hidden from students. In that
+    # case we return whatever we have and fall back to requesting files one by one.
+    try:
+        for file in course.get_files():
+            course_files[str(file.id)] = file
+    except Forbidden:
+        pass
+
+    return course_files
+
+def course_file_getter(course):
+    """
+    Returns a function that takes a file id (str) and returns the course's File object with that id. Files
+        are taken from the course's file index if they are there and requested from Canvas otherwise; either
+        way, the result is cached, so a file linked from several modules and pages is only looked up once
+        per course.
 
     Parameters:
-        - loose_html: html obtained from page (whether in modules or assignment)
         - course: course object, obtained after requesting information using the canvasapi
-        - directory in which files will be downloaded (this is either the appropriate module or assignment)
-        - urls: set of urls that will keep track of all the files we have added
+
     Returns:
-        - None, downloads all attachments on page to hard drive in specified directory
+        - function mapping file ids to File objects. Its course_files attribute holds the file index, for
+          telling whether a file can be looked up without a request.
     """
-    # Use Beautiful Soup to parse page into readable html to locate links
-    parsed_html = BeautifulSoup(loose_html, 'html.parser')
+    # Look up all of the course's files at once; pages and modules refer to files by id, and this saves a
+    # request to Canvas for each of them.
+    course_files = index_course_files(course)
 
-    # Iterate over all <a> and <embed>-tagged objects with href attribute, which iterates over 
-    # each link found.
-    for a_tag in parsed_html.find_all(['a', 'embed'], href = True):
-        file_url = a_tag['href']
+    @functools.lru_cache(maxsize = None)
+    def get_file(file_id):
+        file = course_files.get(file_id)
+        if file is None:
+            file = course.get_file(file_id)
+        return file
 
-        # We check to see if the url fits the format of a file; if it doesn't, we continue on to the next tag.
-        if not (r'/files/'in file_url):
+    get_file.course_files = course_files
+    return get_file
+
+def file_links_from_urls(file_urls):
+    """
+    Picks out the links to course files from a list of links.
+
+    Parameters:
+        - file_urls: list of hrefs found on a page
+
+    Returns:
+        - list of (file id (str), href) pairs, in the order the links appear
+    """
+    file_links = []
+    for file_url in file_urls:
+
+        # Check to see if the url fits the format of a file and find the id of the file; if the url is not
+        # a file, we continue on to the next link.
+        file_id_match = file_href_regex.search(file_url)
+        if not file_id_match:
             continue
+        file_links.append((file_id_match.group(1), file_url))
+
+    return file_links
+
+def links_in_tree(parsed_html):
+    """
+    Collects the href of all <a> and <embed>-tagged objects in a parsed page, which gives us each link found.
+
+    Parameters:
+        - parsed_html: LexborHTMLParser of the page
+
+    Returns:
+        - list of hrefs, in the order they appear
+    """
+    # An attribute written without a value (<a href>) still matches the selector, but has None as its value.
+    hrefs = (node.attributes.get('href') for node in parsed_html.css('a[href], embed[href]'))
+    return [href for href in hrefs if href]
+
+def extract_file_links(loose_html):
+    """
+    Finds all links to course files in the given html.
 
-        # Find the id of the file.
-        file_url_ls = file_url.split('/')
-        file_id = file_url_ls[-1]
+    Parameters:
+        - loose_html: html obtained from page (whether in modules or assignment)
 
-        # The file id is usually the very last element; however, if the id is not an int, we need
-        # to run a few more checks to verify if the file is obtainable. 
+    Returns:
+        - list of (file id (str), href) pairs, in the order the links appear
+    """
+    # Find the links to course files on the page with a regular expression, which is much cheaper than
+    # parsing the whole page.
+    file_urls = [html.unescape(link.group(1)) for link in file_link_regex.finditer(loose_html)]
 
-        if not type(file_id) == int:
-            # sometimes we will see "?verifier=" representing the temporary access key. To resolve this, 
-            # we can simply remove the verifier aspect of the tag. 
-            if '?verifier=' in file_id:
-                file_id = file_id.split('?')[0]
+    # If that found nothing even though the page mentions course files, the HTML is written in a way the
+    # regular expression does not expect (e.g. unquoted attributes). Fall back to an HTML parser.
+    if not file_urls and '/files/' in loose_html:
+        # Use selectolax to parse page into readable html to locate links. Its Lexbor parser is written in C
+        # and keeps the document in C memory, creating Python objects only for the nodes we ask for.
+        parsed_html = LexborHTMLParser(loose_html)
+        file_urls = links_in_tree(parsed_html)
 
-                # However, sometimes this will NOT be the id, and instead be the phrase "download" or "preview". In this
-                # case, the id was the second to last element in the earlier split we did to extract the file.
-                if file_id in ['download', 'preview']:
-                    file_id = file_url_ls[-2]
+    return file_links_from_urls(file_urls)
 
-            # Sometimes we will see "?wrap". We will skip over these
-            elif '?wrap=' in file_id:
-                continue
-        
-            else: #Cannot obtain id; skip this item
+def download_files_from_html(html_or_tree, get_file, dir, store, urls, work_q, base_url):
+    """
+    This function looks through the html and picks out file_ids for all downloadable attachments.
+    Then, we search the course object for the respective files using the file_ids to later download them.
+
+    Parameters:
+        - html_or_tree: html obtained from page (whether in modules or assignment), or a LexborHTMLParser of
+          it if the caller has already parsed the page for other reasons (this avoids parsing it twice)
+        - get_file: function returning the course's File object with a given id, from course_file_getter
+        - dir: Path of the directory in which files will be placed (this is either the appropriate module or assignment)
+        - store: CourseStore of the course, whose directory the files are downloaded into
+        - urls: DownloadLog that will keep track of all the files we have added
+        - work_q: queue of files waiting to be downloaded by the workers
+        - base_url: url of the Canvas site, which relative links are resolved against
+    Returns:
+        - None, puts all attachments on page on the queue to be downloaded into specified directory
+    """
+    # If we were handed an already parsed page, collect the href of all <a> and <embed>-tagged objects in it.
+    if isinstance(html_or_tree, LexborHTMLParser):
+        file_links = file_links_from_urls(links_in_tree(html_or_tree))
+
+    # Otherwise, look through the html here. The regular expression in extract_file_links takes microseconds
+    # per page, far less than sending the page to another process and back would, so the download threads
+    # hardly notice it.
+    else:
+        file_links = extract_file_links(html_or_tree)
+
+    # Pages often link the same file several times (a thumbnail, a link, a preview); only keep one link to
+    # each file, so that we do not look it up more than once. A link with an access key is preferred.
+    hrefs = {}
+    for file_id, href in file_links:
+        if file_id not in hrefs or 'verifier=' in href:
+            hrefs[file_id] = href
+
+    # A file that is not in the course's file index would cost a request to Canvas to look up. If its link
+    # carries an access key, download it straight from the link instead. Only links to the Canvas site
+    # itself are followed this way, since the access token is sent along with the request.
+    canvas_host = urllib.parse.urlsplit(base_url).netloc
+    file_ids = []
+    for file_id, href in hrefs.items():
+        if 'verifier=' in href and file_id not in get_file.course_files:
+            url = urllib.parse.urljoin(base_url, href)
+            if urllib.parse.urlsplit(url).netloc == canvas_host:
+                queue_download(work_q, FileLink(url, file_id), dir, store, urls)
                 continue
+        file_ids.append(file_id)
 
-        # Finally, download the files!
-        file = course.get_file(file_id)
+    # Look up the rest of the page's files at once on the background threads, so that the files missing from
+    # the course's file index are requested from Canvas side by side rather than one after another.
+    files = pagination_executor.map(get_file, file_ids)
 
-        download_file(file, dir, urls)
-    return 
+    # Finally, hand the files over to the pool of workers to download!
+    for file in files:
+        queue_download(work_q, file, dir, store, urls)
+    return
 
-def valid_filetype(file):
+def valid_filetype(filename, content_type = ''):
     """
-    Given a file, returns a boolean (True or False) depending on whether the file is a type
-        we want to download. 
+    Given a file's name and (if known) its content type, returns a boolean (True or False) depending on
+        whether the file is a type we want to download. 
     
     We want the following filetypes:
         - (basically everything)
     
     with the exception of:
-        - Videos (.mp4)
+        - Videos (.mp4, .mkv, ..., or any video/* content type)
     """
-    unwanted_filetypes = set(['mp4', 'mov', 'webm', 'wmv', 'flv', 'ogv', 'avi'])
-    filetype = file.filename.split('.')[-1].lower()
+    if content_type.lower().startswith('video/'):
+        return False
+
+    filetype = filename.rpartition('.')[2].lower()
 
     return not (filetype in unwanted_filetypes)
 # ---------------------------------------------------------------------------------------------
@@ -243,6 +1124,11 @@ class GUI:
         self.begin_download = tk.Button(self.window, text = 'Download Course Materials', font = ('Arial Black', 12), command = self.download_start)
         self.begin_download.pack(padx = 10, pady = 10)
 
+        # Tkinter widgets may only be touched from the thread running the window, so the download thread
+        # puts (text box, message) pairs on this queue and the window writes them out every 50 ms.
+        self.ui_queue = queue.Queue()
+        self.window.after(50, self.drain_ui)
+
         # Allow for window to continuously check for input
         self.window.mainloop()
 
@@ -256,42 +1142,90 @@ class GUI:
         txtbx.delete('1.0', tk.END)
         txtbx.insert('1.0', message)
 
+    def drain_ui(self):
+        # Write out up to 100 queued messages, then check back in 50 ms.
+        for _ in range(100):
+            try:
+                txtbx, message = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.print_to_window(message, txtbx)
+        self.window.after(50, self.drain_ui)
+
     def on_click(self):
         if messagebox.askyesno(title = 'Quit?', message = 'Are you sure you want to quit?'):
             self.window.destroy()
     
+    def download_worker(self, work_q, key):
+        # Download files from the queue until we are handed None, displaying any error messages returned.
+        # Every file is counted as done for its course once handled, so that the course's files get placed.
+        while True:
+            item = work_q.get()
+            if item is None:
+                break
+
+            file, dir, store, urls = item
+            try:
+                file_download_msg = download_with_retries(file, dir, store, urls, key)
+            except Exception as e:
+                file_download_msg = f'The file {file.display_name} could not be downloaded. {e!r} \n'
+                print(file_download_msg)
+            finally:
+                store.item_done()
+
+            if file_download_msg != None:
+                self.ui_queue.put((self.error_course_txtbox, file_download_msg))
+
     def download_start(self):
         if not self.download_button_pressed:
             self.download_button_pressed = True
-            threading.Thread(target = self.download_materials, daemon = True).start()
 
-    def download_materials(self):
-        # Create three text boxes where the current course, (potential) error messages, and termination status 
-        # will be displayed. 
-        self.current_course_txtbox = tk.Text(self.window, height = 1, font = ('Arial', 11))
-        self.current_course_txtbox.pack(padx = 15, pady = 10)
+            # Create three text boxes where the current course, (potential) error messages, and termination status 
+            # will be displayed. These are created here, on the window's thread, rather than in the download thread.
+            self.current_course_txtbox = tk.Text(self.window, height = 1, font = ('Arial', 11))
+            self.current_course_txtbox.pack(padx = 15, pady = 10)
 
-        self.termination = tk.Text(self.window, height = 1, font = ('Arial', 11))
-        self.termination.pack(padx = 15, pady = 10)
+            self.termination = tk.Text(self.window, height = 1, font = ('Arial', 11))
+            self.termination.pack(padx = 15, pady = 10)
 
-        self.error_course_txtbox = tk.Text(self.window, height = 6, font = ('Arial', 11))
-        self.error_course_txtbox.pack(padx = 15, pady = 10)
+            self.error_course_txtbox = tk.Text(self.window, height = 6, font = ('Arial', 11))
+            self.error_course_txtbox.pack(padx = 15, pady = 10)
 
+            # Read the user's input here as well, and hand it over to the download thread.
+            threading.Thread(target = self.download_materials, daemon = True,
+                             args = (self.api_url.get(), self.key.get(), self.path.get())).start()
+
+    def download_materials(self, API_URL, KEY, save_path):
         ## NOTE: The variables defined in this function are not saved as attributes to the class because
         ## they were originally written before the class was created. As such, all variables in this function
         ## will remain LOCAL to the function (unless saved externally in, say, a text file).
 
-        # Save all the relevant pieces of information into variables
-        API_URL = self.api_url.get()
-        KEY = self.key.get()
-        save_path = self.path.get()
-
         # ---------------------------------------------------------------------------------------------
         # ---------------------------------------------------------------------------------------------
         # Extract the course information itself. Initialize a new Canvas object and extract user
         canvas = Canvas(API_URL, KEY)
+
+        # canvasapi makes its own requests (listing courses, modules, pages, ...) through a session of its
+        # own, which does not expose a setting for this; give it the same connection pool.
+        mount_connection_pool(canvas._Canvas__requester._session)
         user = canvas.get_current_user()
 
+        # Save downloaded file urls in a set; we will be iterating through the files of each course from
+        # several places (modules, assignments, the Files section), and a file should only be downloaded
+        # once. The contents of every file downloaded are remembered as well, so that identical files are only
+        # stored once. Both are saved in the save path and reloaded on the next run, so that files which were
+        # already downloaded are skipped immediately.
+        save_path = Path(save_path)
+        ensure_directory(save_path)
+        downloaded_urls = DownloadLog(save_path, save_path / download_log_filename)
+
+        # Start the workers that will download the files we find. Like the download thread itself, they are
+        # daemon threads so that closing the window is never held up by them.
+        work_q = queue.Queue(maxsize = work_queue_size)
+        workers = [threading.Thread(target = self.download_worker, args = (work_q, KEY), daemon = True)
+                   for _ in range(download_workers)]
+        for worker in workers:
+            worker.start()
 
         # Go through every course listed under the student.
         for current_course in canvas.get_courses():
@@ -301,117 +1235,148 @@ class GUI:
             try: 
                 current_course_sign = f'Downloading: {current_course.name}'
                 print(current_course_sign)
-                self.print_to_window(current_course_sign, self.current_course_txtbox)
+                self.ui_queue.put((self.current_course_txtbox, current_course_sign))
             except AttributeError:
                 continue
 
 
-            # Save course file urls in a set; later, we will be iterating through all files in the course,
-            # and for the files that we missed, we will be adding them into a separate files folder.
-            course_items_urls = set()
+            # Whatever happens while going through the course, place each of the files found so far in all of
+            # the folders it was found in once they have finished downloading. The workers do this on their
+            # own, so we move on to the next course meanwhile.
+            store = None
+            try:
+                # For this course, create a folder with the name given in the system for the course. 
+                course_folder_path = save_path / make_valid_folder_name(current_course.name)
+                ensure_directory(course_folder_path)
 
-            # For this course, create a folder with the name given in the system for the course. 
-            course_folder_path = f'{save_path}/{make_valid_folder_name(current_course.name)}'
-            if not os.path.exists(course_folder_path):
-                os.makedirs(course_folder_path)
+                # Each file of the course is downloaded once, into the course's store directory, no matter how
+                # many modules, assignments and folders it is found in.
+                store = CourseStore(course_folder_path / file_store_dirname)
 
-            ## Get Module Items
-            modules_i = current_course.get_modules()
+                # Start paging through the assignments and folders of the course now; Canvas returns these lists
+                # a page at a time, and by the time we get to them the requests will have already been made.
+                assignments_future = pagination_executor.submit(list, current_course.get_assignments())
+                folders_future = pagination_executor.submit(list, current_course.get_folders())
 
-            # Create a directory for all module items
-            modules_dir = f'{course_folder_path}/Modules'
+                # Pages and modules refer to files by id; this looks them up, requesting each file from Canvas
+                # at most once for the whole course.
+                get_file = course_file_getter(current_course)
 
-            # Iterate over each module
-            for module_i in modules_i:
+                ## Get Module Items
+                modules_i = list(current_course.get_modules())
 
-                # For each module, create yet another sub_directory.
-                module_dir = f'{modules_dir}/{make_valid_folder_name(module_i.name)}'
+                # Create a directory for all module items
+                modules_dir = course_folder_path / 'Modules'
 
-                # For each module, retrieve its items
-                module_items = module_i.get_module_items()
+                # Iterate over each module
+                for module_i in modules_i:
 
-                # We are mainly concerned with two types of module items: files and pages.
-                # If they are files, we want to download them, no questions asked.
-                # If they are pages, we want to access the page and scan it for embedded files we can download.
-                # We check for both cases for each module item under this particular module. 
-                for module_item in module_items:
-                    if module_item.type == 'File':
+                    # For each module, create yet another sub_directory.
+                    module_name = make_valid_folder_name(module_i.name)
+                    module_dir = modules_dir / module_name
 
-                        # Find the item's content id, after which we can find it in the course and directly download.
-                        module_item_id = module_item.content_id
-                        file = current_course.get_file(module_item_id)
+                    # For each module, retrieve its items
+                    module_items = list(module_i.get_module_items())
 
-                        file_download_msg = download_file(file, module_dir, course_items_urls)
-                        if file_download_msg != None:
-                            self.print_to_window(file_download_msg, self.error_course_txtbox)
+                    # Request all of the module's pages and files at once rather than one after another.
+                    pages = {module_item.page_url: pagination_executor.submit(current_course.get_page, module_item.page_url)
+                             for module_item in module_items if module_item.type == 'Page'}
+                    files = {module_item.content_id: pagination_executor.submit(get_file, str(module_item.content_id))
+                             for module_item in module_items if module_item.type == 'File'}
 
-                    if module_item.type == 'Page':
-                        page_url = module_item.page_url
-                        page = current_course.get_page(page_url)
+                    # We are mainly concerned with two types of module items: files and pages.
+                    # If they are files, we want to download them, no questions asked.
+                    # If they are pages, we want to access the page and scan it for embedded files we can download.
+                    # We check for both cases for each module item under this particular module. 
+                    for module_item in module_items:
+                        if module_item.type == 'File':
 
-                        # If the page has a body, we can download files from it.
-                        if page.body:
-                            download_files_from_html(page.body, current_course, module_dir, course_items_urls)
+                            # Find the item's content id, after which we can find it in the course and directly download.
+                            module_item_id = module_item.content_id
+                            file = files[module_item_id].result()
 
-            ## Get Assignment Items
-            # Create a folder for assignments
-            assignments_dir = f'{course_folder_path}/Assignments'
+                            queue_download(work_q, file, module_dir, store, downloaded_urls)
 
-            # Obtain all assignments
-            all_assignments = current_course.get_assignments()
+                        if module_item.type == 'Page':
+                            page_url = module_item.page_url
+                            page = pages[page_url].result()
 
-            # For each assignment, do the following:
-            # 1) Open page url
-            # 2) Download all embedded pdfs 
-            # 3) Download all submissions
-            for assignment in all_assignments:
-                assignment_query = assignment
-                    
-                # Open page URL and obtain assignment ID (last element in URL)
-                assignment_url = assignment_query.html_url
-                assignment_id = assignment_url.split('/')[-1]
+                            # If the page has a body, we can download files from it.
+                            if page.body:
+                                download_files_from_html(page.body, get_file, module_dir, store, downloaded_urls, work_q, API_URL)
 
-                # With ID, obtain assignment
-                assignment = current_course.get_assignment(assignment_id)
+                ## Get Assignment Items
+                # Create a folder for assignments
+                assignments_dir = course_folder_path / 'Assignments'
 
-                # Obtain name of this assignment and create a new folder to save the assignment's materials into
-                assignment_dir = f'{assignments_dir}/{make_valid_folder_name(assignment.name)}'
+                # Obtain all assignments (fetched in the background since the start of the course)
+                all_assignments = assignments_future.result()
 
-                # Get Page object associated with assignment
-                assignment_page = assignment.description
+                # For each assignment, do the following:
+                # 1) Create a folder for the assignment
+                # 2) Download all embedded pdfs 
+                for assignment in all_assignments:
 
-                ## Download all embedded pdfs if the assignment page exists
-                if assignment_page:
-                    download_files_from_html(assignment_page, current_course, assignment_dir, course_items_urls)
+                    # The assignments listed for the course already come with their descriptions. Only if one is
+                    # missing do we request the assignment on its own.
+                    if not hasattr(assignment, 'description'):
+                        assignment = current_course.get_assignment(assignment.id)
 
-            ## Get files stored under the Files section, which we can get via get_folders. 
-            Files_dir = f'{course_folder_path}'
-            folders = current_course.get_folders()
-            for folder in folders:
+                    # Obtain name of this assignment and create a new folder to save the assignment's materials into
+                    assignment_name = make_valid_folder_name(assignment.name)
+                    assignment_dir = assignments_dir / assignment_name
 
-                # Create folder path combined with the Files_dir
-                folder_path = f'{Files_dir}/{folder}'
-                
-                # Get all the files from each folder, and download the file only if it has not already been
-                # downloaded previously.
-                folder_files = folder.get_files()
+                    # Get Page object associated with assignment
+                    assignment_page = assignment.description
+
+                    ## Download all embedded pdfs if the assignment page exists
+                    if assignment_page:
+                        download_files_from_html(assignment_page, get_file, assignment_dir, store, downloaded_urls, work_q, API_URL)
 
-                # Attempt to access the files. If it is forbidden, break out of for loop (we do not have
-                # the necessary permissions to download).
+                ## Get files stored under the Files section, which we can get via get_folders. 
+                # If the Files section is hidden from students, even listing the folders is forbidden.
+                Files_dir = course_folder_path
                 try:
-                    for file in folder_files:
-                        file_download_msg = download_file(file, folder_path, course_items_urls)
-                        if file_download_msg != None:
-                            self.print_to_window(file_download_msg, self.error_course_txtbox)
+                    folders = folders_future.result()
                 except Forbidden:
-                    break
+                    print(f'The Files section of {current_course.name} could not be accessed.')
+                    folders = []
+
+                for folder in folders:
+
+                    # Create folder path combined with the Files_dir
+                    folder_path = Files_dir / str(folder)
+                
+                    # Get all the files from each folder, and download the file only if it has not already been
+                    # downloaded previously. Attempt to access the files. If it is forbidden, we do not have the
+                    # necessary permissions to download from this folder, but may still have them for the next one.
+                    try:
+                        folder_files = list(folder.get_files())
+                    except Forbidden:
+                        print(f'The folder {folder} could not be accessed.')
+                        continue
+
+                    for file in folder_files:
+                        queue_download(work_q, file, folder_path, store, downloaded_urls)
+            finally:
+                if store is not None:
+                    store.listing_done()
+
+        # Tell each worker to stop once the queue has been emptied, and wait for the last downloads to finish
+        # (and the last course's files to be placed).
+        for _ in workers:
+            work_q.put(None)
+        for worker in workers:
+            worker.join()
 
         # We can also type to the client that we are done!
-        self.print_to_window('All course files have been downloaded!', self.termination)
+        self.ui_queue.put((self.termination, 'All course files have been downloaded!'))
 
 
 #########################################################
 #########################################################
 #########################################################
 
-main_window = GUI()
+# Only open the window when this file is run directly.
+if __name__ == '__main__':
+    main_window = GUI()